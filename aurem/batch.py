@@ -0,0 +1,551 @@
+import glob
+import logging
+import time
+import configparser
+import multiprocessing as mp
+from collections import namedtuple
+import numpy as np
+from obspy import read, Stream, Trace, UTCDateTime
+#
+from aurem.pickers import AIC, REC
+from aurem import metrics as AUME
+
+logger = logging.getLogger(__name__)
+
+
+PICKERS = {"aic": AIC, "rec": REC}
+
+
+def pick_dtype(filelen=1, idlen=1):
+    """ Return the PICK_DTYPE layout with the given string-field widths
+
+    The batch APIs size the `file` and `id` fields from the data: use
+    this function to build arrays for strings longer than the
+    PICK_DTYPE default widths.
+    """
+    return np.dtype([("file", "U%d" % max(filelen, 1)),
+                     ("id", "U%d" % max(idlen, 1)),
+                     ("pick_ns", np.int64),
+                     ("index", np.int64),
+                     ("cf", np.float32),
+                     ("npts", np.int64)])
+
+
+# Columnar (structured array) layout of the batch picks. The pick time
+# is stored as int64 epoch nanoseconds, NO_PICK_NS marks missing picks.
+# PICK_DTYPE has default widths safe for file paths and (FDSN source)
+# identifiers; the arrays returned by the batch APIs are instead sized
+# from the data (`pick_dtype`), so strings are never truncated.
+PICK_DTYPE = pick_dtype(filelen=1024, idlen=128)
+NO_PICK_NS = np.iinfo(np.int64).min
+
+# Result of a single waveform file: `picks` is a list of `pick_trace`
+# tuples (or a PICK_DTYPE array), `error` the reading error message
+# (or None), `failed` the number of traces failing the picking and
+# `metrics` the aurem.metrics snapshot of a pool worker (or None).
+FileResult = namedtuple("FileResult",
+                        ["file", "picks", "error", "failed", "metrics"])
+
+
+# =======================  Common
+
+def _to_pick_array(rows):
+    """ Convert PICK_DTYPE tuples into a structured array sized on data """
+    if not rows:
+        return np.empty(0, dtype=pick_dtype())
+    return np.array(rows, dtype=pick_dtype(
+                                max(len(_rr[0]) for _rr in rows),
+                                max(len(_rr[1]) for _rr in rows)))
+
+
+def concatenate_picks(chunks):
+    """Concatenate PICK_DTYPE structured arrays of different widths
+
+    Inputs:
+        chunks (list): list of PICK_DTYPE structured arrays
+
+    Returns:
+        picks (np.ndarray): the concatenated structured array
+
+    """
+    chunks = [_cc for _cc in chunks if _cc.size > 0]
+    if not chunks:
+        return np.empty(0, dtype=pick_dtype())
+    # String widths sized on the actual data, not on the input dtypes
+    dtype = pick_dtype(max(int(np.char.str_len(_cc["file"]).max())
+                           for _cc in chunks),
+                       max(int(np.char.str_len(_cc["id"]).max())
+                           for _cc in chunks))
+    return np.concatenate([_cc.astype(dtype) for _cc in chunks])
+
+
+def _convert_value(value):
+    """Convert a config-file string into int, float or bool if possible
+
+    Inputs:
+        value (str): raw value read from the configuration file
+
+    Returns:
+        value (int, float, bool, str): the converted value
+
+    """
+    for _conv in (int, float):
+        try:
+            return _conv(value)
+        except ValueError:
+            pass
+    if value.lower() in ("true", "yes", "on"):
+        return True
+    if value.lower() in ("false", "no", "off"):
+        return False
+    return value
+
+
+def load_config(configfile):
+    """Read the batch-picking configuration file
+
+    The file is a standard INI file with the following (all optional)
+    sections:
+
+        [select]  key-args for the obspy.Stream.select() method
+        [filter]  `type` plus key-args for the obspy.Trace.filter()
+        [trim]    `starttime`/`endtime` as UTC strings, or
+                  `start_offset`/`end_offset` in seconds relative to
+                  the trace start
+
+    Inputs:
+        configfile (str, pathlib.Path): path to the configuration file
+
+    Returns:
+        config (dict): dictionary of dictionaries, one per section
+
+    """
+    parser = configparser.ConfigParser()
+    if not parser.read(str(configfile)):
+        raise FileNotFoundError("Config file not found: %s" % configfile)
+    #
+    config = {}
+    if parser.has_section("select"):
+        # Selection keys are SEED codes (e.g. location "00"): raw strings
+        config["select"] = dict(parser.items("select"))
+    for _sect in ("filter", "trim"):
+        if parser.has_section(_sect):
+            config[_sect] = {_kk: _convert_value(_vv)
+                             for _kk, _vv in parser.items(_sect)}
+    if "filter" in config and "type" not in config["filter"]:
+        raise ValueError("Config [filter] section needs a `type` key!")
+    return config
+
+
+def expand_inputs(inputs):
+    """Expand a list of file paths and/or glob patterns
+
+    Inputs:
+        inputs (list, tuple): file paths or glob patterns
+
+    Returns:
+        files (list): sorted, unique list of matching files
+
+    """
+    files = set()
+    for _ii in inputs:
+        _match = glob.glob(str(_ii), recursive=True)
+        if not _match:
+            logger.warning("No file matches input: %s" % _ii)
+        files.update(_match)
+    return sorted(files)
+
+
+def _process_traces(traces, config, copy=True):
+    """ Apply the filter/trim settings of config to (copies of) traces
+
+    The traces are the segments of a single recording: the trim
+    offsets are relative to the earliest segment start, and segments
+    left empty by the trim are dropped.
+    Use copy=False only when the caller owns the traces, as the
+    processing is then done in place.
+    """
+    if copy:
+        traces = [_tr.copy() for _tr in traces]
+    if "filter" in config:
+        for _tr in traces:
+            _filt = dict(config["filter"])
+            _tr.filter(_filt.pop("type"), **_filt)
+    if "trim" in config:
+        _trim = config["trim"]
+        _start = min(_tr.stats.starttime for _tr in traces)
+        t1 = _trim.get("starttime")
+        t2 = _trim.get("endtime")
+        t1 = UTCDateTime(t1) if t1 else None
+        t2 = UTCDateTime(t2) if t2 else None
+        if "start_offset" in _trim:
+            t1 = _start + float(_trim["start_offset"])
+        if "end_offset" in _trim:
+            t2 = _start + float(_trim["end_offset"])
+        for _tr in traces:
+            _tr.trim(t1, t2)
+        traces = [_tr for _tr in traces if _tr.stats.npts > 0]
+        if not traces:
+            raise ValueError("No data left after trimming")
+    return traces
+
+
+# =======================  Main
+
+def _check_method(method):
+    if method.lower() not in PICKERS:
+        raise ValueError("Method must be one of: %s" %
+                         ", ".join(sorted(PICKERS)))
+
+
+def _run_picker(trace, method, config, copy=True):
+    """ Process trace (or its segments) and run the picker
+
+    Returns:
+        picker (AIC, REC): the picker after the `work` method
+        npts (int): number of samples picked
+
+    """
+    _check_method(method)
+    traces = [trace] if isinstance(trace, Trace) else list(trace)
+    traces = _process_traces(traces, config or {}, copy=copy)
+    picker = PICKERS[method.lower()](Stream(traces=traces))
+    picker.work()
+    return (picker, sum(_seg.stats.npts for _seg in picker.segments))
+
+
+def pick_trace(trace, method="aic", config=None, copy=True):
+    """Run a picker over a single trace
+
+    Args:
+        trace (obspy.Trace, list): the trace to be picked, or the list
+            of its segments (same trace id, gappy recording)
+
+    Optionals:
+        method (str): either "aic" or "rec"
+        config (dict): processing settings as returned by `load_config`
+        copy (bool): if False, the trace is processed in place
+
+    Returns:
+        result (tuple): (trace id, pick UTCDateTime or None,
+            pick index, number of samples)
+
+    """
+    picker, npts = _run_picker(trace, method, config, copy=copy)
+    return (picker.wt.id, picker.pick, picker.idx, npts)
+
+
+def pick_trace_row(trace, method="aic", config=None, copy=True):
+    """Run a picker over a single trace, columnar output
+
+    Same as `pick_trace`, but the pick time is returned as int64
+    epoch nanoseconds computed from the trace start, so that no
+    per-pick time object is needed downstream.
+
+    Returns:
+        row (tuple): (trace id, pick epoch-ns or NO_PICK_NS,
+            pick index, CF value at index, number of samples).
+            The tuple matches the PICK_DTYPE layout, without the
+            leading `file` field.
+
+    """
+    picker, npts = _run_picker(trace, method, config, copy=copy)
+    _cf = picker.recfn if isinstance(picker, REC) else picker.aicfn
+    _stats = picker.wt.stats
+    if picker.pick is not None:
+        pick_ns = (_stats.starttime.ns +
+                   int(round(picker.idx * _stats.delta * 1e9)))
+    else:
+        pick_ns = NO_PICK_NS
+    return (picker.wt.id, pick_ns, picker.idx,
+            _cf[picker.idx] if _cf.size > 0 else np.nan,
+            npts)
+
+
+def pick_file(filepath, method="aic", config=None, columnar=False):
+    """Read a waveform file (miniSEED, SAC, ...) and pick all its traces
+
+    Args:
+        filepath (str, pathlib.Path): path to the waveform file
+
+    Optionals:
+        method (str): either "aic" or "rec"
+        config (dict): processing settings as returned by `load_config`
+        columnar (bool): if True, return a PICK_DTYPE structured array
+            instead of a list of tuples
+
+    Returns:
+        results (list, np.ndarray): list of `pick_trace` tuples, one
+            per trace id (or structured array if columnar). The traces
+            sharing the same id (gappy data) are picked together as
+            segments of a single recording, without merging them.
+            Traces failing the picking are logged and skipped.
+
+    """
+    return _pick_file(filepath, method, config, columnar)[0]
+
+
+def _pick_file(filepath, method, config, columnar):
+    """ Same as `pick_file`, return (results, number of failed traces) """
+    config = config or {}
+    st = read(str(filepath))
+    if "select" in config:
+        st = st.select(**config["select"])
+    #
+    _groups = {}
+    for tr in st:
+        _groups.setdefault(tr.id, []).append(tr)
+    #
+    _picktrace = pick_trace_row if columnar else pick_trace
+    results, failed = [], 0
+    for _id, _segments in _groups.items():
+        try:
+            # The traces just read are owned here: no need to copy them
+            _res = _picktrace(_segments, method=method, config=config,
+                              copy=False)
+            results.append((str(filepath),) + _res if columnar else _res)
+        except Exception as err:
+            failed += 1
+            logger.error("Failed picking %s in %s: %s" %
+                         (_id, filepath, err))
+    if columnar:
+        return (_to_pick_array(results), failed)
+    return (results, failed)
+
+
+def _pick_file_worker(args):
+    """ Pool worker: never raise, return a FileResult
+
+    With `metrics` True (pool processes), the picking metrics of the
+    file are collected in this process and returned as a snapshot, to
+    be merged in the parent process registry.
+    """
+    filepath, method, config, columnar, metrics = args
+    if metrics:
+        AUME.REGISTRY.reset()
+        AUME.enable()
+    try:
+        results, failed = _pick_file(filepath, method, config, columnar)
+        error = None
+    except Exception as err:
+        results = np.empty(0, dtype=pick_dtype()) if columnar else []
+        failed, error = 0, str(err)
+    return FileResult(filepath, results, error, failed,
+                      AUME.REGISTRY.snapshot() if metrics else None)
+
+
+def iter_picks(files, method="aic", config=None, workers=1,
+               columnar=False):
+    """Lazily pick a list of waveform files
+
+    Results are yielded file by file as soon as they are produced, so
+    that the caller can stream them to disk without collecting the
+    whole batch in memory. With more than one worker, files are
+    distributed over a process pool and yielded in completion order.
+    If aurem.metrics is enabled, the metrics collected by the pool
+    processes are merged into the registry of the calling process.
+
+    Args:
+        files (list): list of waveform file paths
+
+    Optionals:
+        method (str): either "aic" or "rec"
+        config (dict): processing settings as returned by `load_config`
+        workers (int): number of parallel processes
+        columnar (bool): if True, each file results are returned as a
+            PICK_DTYPE structured array
+
+    Yields:
+        result (FileResult): (filepath, list of `pick_trace` tuples or
+            structured array, error message or None, number of traces
+            failing the picking, worker metrics snapshot or None)
+
+    """
+    _check_method(method)
+    if workers <= 1:
+        for _ff in files:
+            yield _pick_file_worker((_ff, method, config or {}, columnar,
+                                     False))
+    else:
+        _metrics = AUME.is_enabled()
+        tasks = ((_ff, method, config or {}, columnar, _metrics)
+                 for _ff in files)
+        with mp.Pool(processes=workers) as pool:
+            for _res in pool.imap_unordered(_pick_file_worker, tasks):
+                if _res.metrics:
+                    AUME.REGISTRY.merge(_res.metrics)
+                yield _res
+
+
+def pick_columnar(files, method="aic", config=None, workers=1):
+    """Pick a list of waveform files into a single structured array
+
+    Args:
+        files (list): list of waveform file paths
+
+    Optionals:
+        method (str): either "aic" or "rec"
+        config (dict): processing settings as returned by `load_config`
+        workers (int): number of parallel processes
+
+    Returns:
+        picks (np.ndarray): PICK_DTYPE structured array, one row per
+            trace. Missing picks have `pick_ns == NO_PICK_NS`.
+
+    """
+    _chunks = [_res.picks for _res in
+               iter_picks(files, method=method, config=config,
+                          workers=workers, columnar=True)]
+    return concatenate_picks(_chunks)
+
+
+# =======================  Arrow / Parquet / Feather
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("The `pyarrow` package is needed for Arrow, "
+                          "Parquet and Feather outputs: "
+                          "pip install pyarrow")
+    return pyarrow
+
+
+def _arrow_schema():
+    pa = _import_pyarrow()
+    return pa.schema([("file", pa.string()),
+                      ("id", pa.string()),
+                      ("pick", pa.timestamp("ns", tz="UTC")),
+                      ("index", pa.int64()),
+                      ("cf", pa.float32()),
+                      ("npts", pa.int64())])
+
+
+def picks_to_arrow(picks):
+    """Convert a PICK_DTYPE structured array into a pyarrow.Table
+
+    The `pick_ns` column becomes a UTC nanosecond timestamp column
+    named `pick`, with nulls in place of the missing picks.
+
+    Args:
+        picks (np.ndarray): PICK_DTYPE structured array
+
+    Returns:
+        table (pyarrow.Table): the columnar table of picks
+
+    """
+    pa = _import_pyarrow()
+    schema = _arrow_schema()
+    _nopick = picks["pick_ns"] == NO_PICK_NS
+    return pa.Table.from_arrays([
+        pa.array(picks["file"], type=pa.string()),
+        pa.array(picks["id"], type=pa.string()),
+        pa.array(picks["pick_ns"], mask=_nopick,
+                 type=pa.int64()).cast(schema.field("pick").type),
+        pa.array(picks["index"], type=pa.int64()),
+        pa.array(picks["cf"], type=pa.float32()),
+        pa.array(picks["npts"], type=pa.int64())], schema=schema)
+
+
+class ColumnarWriter(object):
+    """ Stream PICK_DTYPE structured arrays to a Parquet/Feather file.
+
+    Every call to `write` appends a new record-batch (row-group for
+    Parquet) to the output file, so that the whole catalog never
+    needs to be held in memory. Use it as a context manager or call
+    the `close` method at the end.
+
+    Args:
+        filepath (str, pathlib.Path): output file path
+        fmt (str): either "parquet" or "feather"
+
+    """
+    def __init__(self, filepath, fmt="parquet"):
+        pa = _import_pyarrow()
+        self.fmt = fmt.lower()
+        if self.fmt == "parquet":
+            import pyarrow.parquet as pq
+            self._writer = pq.ParquetWriter(str(filepath), _arrow_schema())
+        elif self.fmt == "feather":
+            # Feather V2 is the Arrow IPC file format
+            self._writer = pa.ipc.new_file(str(filepath), _arrow_schema())
+        else:
+            raise ValueError("Format must be either 'parquet' or 'feather'")
+
+    def write(self, picks):
+        """ Append a PICK_DTYPE structured array to the file """
+        if picks.size > 0:
+            self._writer.write_table(picks_to_arrow(picks))
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_picks(picks, filepath, fmt="parquet"):
+    """Write a PICK_DTYPE structured array to a Parquet/Feather file
+
+    Args:
+        picks (np.ndarray): PICK_DTYPE structured array
+        filepath (str, pathlib.Path): output file path
+
+    Optionals:
+        fmt (str): either "parquet" or "feather"
+
+    """
+    with ColumnarWriter(filepath, fmt=fmt) as writer:
+        writer.write(picks)
+
+
+class BatchStats(object):
+    """ Collect throughput statistics of a batch-picking run.
+
+    Use the `update` method with each `iter_picks` result, and
+    `summary` at the end of the run.
+
+    """
+    def __init__(self):
+        self.files = 0
+        self.failed_files = 0
+        self.failed_traces = 0
+        self.traces = 0
+        self.picks = 0
+        self.samples = 0
+        self.start = time.perf_counter()
+
+    def update(self, result):
+        """ Update the counters with an `iter_picks` result """
+        picks = result.picks
+        self.files += 1
+        if result.error:
+            self.failed_files += 1
+        self.failed_traces += result.failed
+        if isinstance(picks, np.ndarray):
+            self.traces += picks.size
+            self.samples += int(picks["npts"].sum())
+            self.picks += int(np.count_nonzero(
+                                    picks["pick_ns"] != NO_PICK_NS))
+            return
+        for (_, _pick, _, _npts) in picks:
+            self.traces += 1
+            self.samples += _npts
+            if _pick is not None:
+                self.picks += 1
+
+    def summary(self):
+        """ Return a human-readable report of the run throughput """
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        return "\n".join([
+            "Files:     %d (%d failed)" % (self.files, self.failed_files),
+            "Traces:    %d (%d picked, %d no-pick, %d failed)" % (
+                self.traces + self.failed_traces, self.picks,
+                self.traces - self.picks, self.failed_traces),
+            "Elapsed:   %.3f s" % elapsed,
+            "Rate:      %.2f files/s - %.2f traces/s - %.3e samples/s" % (
+                self.files / elapsed, self.traces / elapsed,
+                self.samples / elapsed)])
@@ -0,0 +1,145 @@
+import sys
+import csv
+import logging
+import argparse
+import configparser
+#
+from aurem import __version__
+from aurem import batch as AUBA
+from aurem import metrics as AUME
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+                prog="aurem-pick",
+                description="Batch AIC/REC picking of waveform files "
+                            "(miniSEED, SAC, ...). Picks are streamed "
+                            "to the output as soon as they are produced.")
+    parser.add_argument("inputs", nargs="+",
+                        help="waveform files or glob patterns "
+                             "(quote patterns to avoid shell expansion)")
+    parser.add_argument("-m", "--method", default="aic",
+                        choices=sorted(AUBA.PICKERS),
+                        help="picking method (default: aic)")
+    parser.add_argument("-c", "--config", default=None,
+                        help="INI file with [select], [filter] and "
+                             "[trim] settings")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="number of parallel processes (default: 1)")
+    parser.add_argument("-o", "--output", default="-",
+                        help="output file (default: stdout, CSV only)")
+    parser.add_argument("-f", "--format", default="csv",
+                        choices=["csv", "parquet", "feather"],
+                        help="output format (default: csv). Parquet and "
+                             "Feather outputs need the pyarrow package")
+    parser.add_argument("--metrics-file", default=None,
+                        help="enable the picking metrics and write them "
+                             "in Prometheus text format to this file at "
+                             "the end of the run")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="enable the picking metrics and serve them "
+                             "on http://127.0.0.1:PORT during the run")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="do not print the end-of-run statistics")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="verbose logging")
+    parser.add_argument("--version", action="version",
+                        version="%(prog)s " + __version__)
+    return parser.parse_args(argv)
+
+
+def _write_csv(files, args, config, stats):
+    """ Stream the picks in CSV format, one file at a time """
+    outfile = (sys.stdout if args.output == "-" else
+               open(args.output, "w", newline=""))
+    try:
+        writer = csv.writer(outfile, lineterminator="\n")
+        writer.writerow(["file", "id", "method", "pick", "index", "npts"])
+        for result in AUBA.iter_picks(files, method=args.method,
+                                      config=config,
+                                      workers=args.workers):
+            if result.error:
+                logger.error("Failed reading %s: %s" %
+                             (result.file, result.error))
+            for (_id, _pick, _idx, _npts) in result.picks:
+                writer.writerow([result.file, _id, args.method.upper(),
+                                 _pick if _pick is not None else "",
+                                 _idx, _npts])
+            outfile.flush()
+            stats.update(result)
+    finally:
+        if outfile is not sys.stdout:
+            outfile.close()
+
+
+def _write_columnar(files, args, config, stats):
+    """ Stream the picks in Parquet/Feather format, one file at a time """
+    with AUBA.ColumnarWriter(args.output, fmt=args.format) as writer:
+        for result in AUBA.iter_picks(files, method=args.method,
+                                      config=config,
+                                      workers=args.workers,
+                                      columnar=True):
+            if result.error:
+                logger.error("Failed reading %s: %s" %
+                             (result.file, result.error))
+            writer.write(result.picks)
+            stats.update(result)
+
+
+def main(argv=None):
+    """ Entry point of the `aurem-pick` console script """
+    args = _parse_args(argv)
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARNING,
+        format="%(levelname)s %(name)s: %(message)s")
+    #
+    if args.workers < 1:
+        logger.error("Number of workers must be at least 1")
+        return 2
+    if args.format != "csv":
+        if args.output == "-":
+            logger.error("An output file is needed for %s format" %
+                         args.format)
+            return 2
+        try:
+            AUBA._import_pyarrow()
+        except ImportError as err:
+            logger.error(str(err))
+            return 2
+    try:
+        config = AUBA.load_config(args.config) if args.config else {}
+    except (FileNotFoundError, ValueError, configparser.Error) as err:
+        logger.error("Invalid config file: %s" % err)
+        return 2
+    files = AUBA.expand_inputs(args.inputs)
+    if not files:
+        logger.error("No input file found!")
+        return 1
+    #
+    server = None
+    if args.metrics_file or args.metrics_port is not None:
+        AUME.enable()
+    if args.metrics_port is not None:
+        server = AUME.start_http_server(port=args.metrics_port)
+    #
+    stats = AUBA.BatchStats()
+    try:
+        if args.format == "csv":
+            _write_csv(files, args, config, stats)
+        else:
+            _write_columnar(files, args, config, stats)
+    finally:
+        if args.metrics_file:
+            AUME.dump(args.metrics_file)
+        if server:
+            server.shutdown()
+    #
+    if not args.quiet:
+        sys.stderr.write(stats.summary() + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,270 @@
+import os
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+# Upper bounds of the picking latency histogram (seconds)
+LATENCY_BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2,
+                   5e-2, 0.1, 0.5, 1.0, 5.0)
+# Upper bounds of the trace-length (samples) label
+LENGTH_BUCKETS = (1000, 10000, 100000, 1000000)
+
+_COUNTERS = (
+    ("aurem_traces_total", "Number of traces processed by the pickers."),
+    ("aurem_samples_total", "Number of samples processed by the pickers."),
+    ("aurem_nopicks_total", "Number of traces without pick (idx == 0)."),
+    ("aurem_errors_total", "Number of failed C-routine calls."))
+_HISTOGRAM = ("aurem_pick_duration_seconds",
+              "Latency of the CF calculation and pick extraction.")
+
+
+# =======================  Common
+
+def _length_bucket(npts):
+    """ Return the trace-length label (upper bound) of npts samples """
+    for _bound in LENGTH_BUCKETS:
+        if npts <= _bound:
+            return str(_bound)
+    return "+Inf"
+
+
+def _format_labels(labels):
+    return ",".join('%s="%s"' % (_kk, str(_vv).replace('"', '\\"'))
+                    for _kk, _vv in labels)
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+# =======================  Main
+
+class Registry(object):
+    """ Thread-safe store of the picking metrics.
+
+    Counters and latency histograms are labelled per picking method
+    (AIC, REC), engine (dense, masked or segmented C-routine call) and
+    trace-length bucket (upper bound in samples).
+
+    Optional:
+        latency_buckets (tuple): upper bounds of the latency histogram
+
+    """
+    def __init__(self, latency_buckets=LATENCY_BUCKETS):
+        self._lock = threading.Lock()
+        self.latency_buckets = tuple(sorted(latency_buckets))
+        self.reset()
+
+    def reset(self):
+        """ Set all the counters and histograms to zero """
+        with self._lock:
+            self._counters = {_name: {} for _name, _ in _COUNTERS}
+            self._histograms = {}
+
+    def observe_pick(self, method, engine, npts, seconds,
+                     picked=True, error=False):
+        """Record a single picking call
+
+        Args:
+            method (str): picking method (e.g. "AIC")
+            engine (str): C-routine engine (e.g. "dense")
+            npts (int): number of processed samples
+            seconds (float): duration of the call
+
+        Optional:
+            picked (bool): False if the routine didn't pick (idx == 0)
+            error (bool): True if the routine failed
+
+        """
+        labels = (("method", method), ("engine", engine),
+                  ("length_le", _length_bucket(npts)))
+        with self._lock:
+            _cnt = self._counters
+            _cnt["aurem_traces_total"][labels] = (
+                _cnt["aurem_traces_total"].get(labels, 0) + 1)
+            _cnt["aurem_samples_total"][labels] = (
+                _cnt["aurem_samples_total"].get(labels, 0) + npts)
+            if error:
+                _cnt["aurem_errors_total"][labels] = (
+                    _cnt["aurem_errors_total"].get(labels, 0) + 1)
+                return
+            if not picked:
+                _cnt["aurem_nopicks_total"][labels] = (
+                    _cnt["aurem_nopicks_total"].get(labels, 0) + 1)
+            # [bucket counts..., sum, count]
+            _hist = self._histograms.setdefault(
+                        labels, [0] * len(self.latency_buckets) + [0.0, 0])
+            for _ii, _bound in enumerate(self.latency_buckets):
+                if seconds <= _bound:
+                    _hist[_ii] += 1
+                    break
+            _hist[-2] += seconds
+            _hist[-1] += 1
+
+    def snapshot(self):
+        """Return a picklable copy of the metrics
+
+        Use it with the `merge` method to collect the metrics of other
+        processes (e.g. multiprocessing workers).
+
+        Returns:
+            snapshot (dict): counters and histograms values
+
+        """
+        with self._lock:
+            return {"counters": {_name: dict(_vals) for _name, _vals in
+                                 self._counters.items()},
+                    "histograms": {_lab: list(_hist) for _lab, _hist in
+                                   self._histograms.items()}}
+
+    def merge(self, snapshot):
+        """ Add the values of a `snapshot` (same buckets) to the metrics """
+        with self._lock:
+            for _name, _vals in snapshot["counters"].items():
+                _cnt = self._counters.setdefault(_name, {})
+                for _lab, _val in _vals.items():
+                    _cnt[_lab] = _cnt.get(_lab, 0) + _val
+            for _lab, _hist in snapshot["histograms"].items():
+                _mine = self._histograms.setdefault(
+                            _lab, [0] * len(self.latency_buckets) + [0.0, 0])
+                for _ii, _val in enumerate(_hist):
+                    _mine[_ii] += _val
+
+    def render(self):
+        """Return the metrics in Prometheus text exposition format
+
+        Returns:
+            text (str): the exposition text (version 0.0.4)
+
+        """
+        lines = []
+        with self._lock:
+            for _name, _help in _COUNTERS:
+                lines.append("# HELP %s %s" % (_name, _help))
+                lines.append("# TYPE %s counter" % _name)
+                for _lab, _val in sorted(self._counters[_name].items()):
+                    lines.append("%s{%s} %s" % (
+                        _name, _format_labels(_lab), _format_value(_val)))
+            #
+            _name, _help = _HISTOGRAM
+            lines.append("# HELP %s %s" % (_name, _help))
+            lines.append("# TYPE %s histogram" % _name)
+            for _lab, _hist in sorted(self._histograms.items()):
+                _cumul = 0
+                for _bound, _count in zip(self.latency_buckets + ("+Inf",),
+                                          _hist[:-2] + [_hist[-1]]):
+                    _cumul = _count if _bound == "+Inf" else _cumul + _count
+                    lines.append("%s_bucket{%s} %d" % (
+                        _name,
+                        _format_labels(_lab + (("le", _bound),)),
+                        _cumul))
+                lines.append("%s_sum{%s} %s" % (
+                    _name, _format_labels(_lab), repr(_hist[-2])))
+                lines.append("%s_count{%s} %d" % (
+                    _name, _format_labels(_lab), _hist[-1]))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+_ENABLED = False
+
+
+def enable():
+    """ Start collecting the picking metrics (disabled by default) """
+    global _ENABLED
+    _ENABLED = True
+
+
+def disable():
+    """ Stop collecting the picking metrics """
+    global _ENABLED
+    _ENABLED = False
+
+
+def is_enabled():
+    return _ENABLED
+
+
+def observe_pick(method, engine, npts, seconds, picked=True, error=False):
+    """ Record a picking call in the global REGISTRY, if enabled """
+    if _ENABLED:
+        REGISTRY.observe_pick(method, engine, npts, seconds,
+                              picked=picked, error=error)
+
+
+def render():
+    """ Return the global REGISTRY in Prometheus text format """
+    return REGISTRY.render()
+
+
+def dump(filepath):
+    """Write the metrics to a file in Prometheus text format
+
+    The file is written atomically (temporary file + rename), with mode
+    0644, so that it can be safely scraped by e.g. the node_exporter
+    textfile collector.
+
+    Args:
+        filepath (str, pathlib.Path): output file path
+
+    """
+    filepath = os.path.abspath(str(filepath))
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(filepath),
+                                   prefix=".aurem_metrics_")
+    try:
+        with os.fdopen(fd, "w") as OUT:
+            OUT.write(render())
+        # mkstemp creates 0600 files: make it readable by the scrapers
+        os.chmod(tmppath, 0o644)
+        os.replace(tmppath, filepath)
+    except Exception:
+        os.remove(tmppath)
+        raise
+
+
+def start_http_server(port=9464, addr="127.0.0.1"):
+    """Expose the metrics via a local HTTP endpoint
+
+    The server runs in a daemon thread and answers any GET request with
+    the Prometheus text format of the global REGISTRY.
+
+    Optional:
+        port (int): listening port (0 for a random free port)
+        addr (str): listening address
+
+    Returns:
+        server (http.server.HTTPServer): the running server. Use its
+            `shutdown` method to stop it.
+
+    """
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class _MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type",
+                             "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            logger.debug(fmt % args)
+
+    class _MetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = _MetricsServer((addr, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name="aurem-metrics", daemon=True)
+    thread.start()
+    logger.info("Serving aurem metrics on http://%s:%d" %
+                server.server_address[:2])
+    return server
@@ -1,45 +1,157 @@
+import time
 import logging
+import importlib
 import numpy as np
-import pathlib
-import ctypes as C
 import copy
 from obspy import UTCDateTime
 #
-from aurem import plotting as AUPL
+from aurem import metrics as AUME
 
 logger = logging.getLogger(__name__)
 
 
-# -------------------------------------------  Load and Setup C library
-MODULEPATH = pathlib.Path(__file__).parent.absolute()
-
-libname = tuple(MODULEPATH.glob("src/aurem_clib.*.so"))[0]
-myclib = C.CDLL(libname)
-
-# AIC
-myclib.aicp.restype = C.c_int
-myclib.aicp.argtypes = [np.ctypeslib.ndpointer(
-                                        dtype=np.float32, ndim=1,
-                                        flags='C_CONTIGUOUS'), C.c_int,
-                        # OUT
-                        np.ctypeslib.ndpointer(
-                                        dtype=np.float32, ndim=1,
-                                        flags='C_CONTIGUOUS'),
-                        C.POINTER(C.c_int)]
-
-# REC
-myclib.recp.restype = C.c_int
-myclib.recp.argtypes = [np.ctypeslib.ndpointer(
-                                        dtype=np.float32, ndim=1,
-                                        flags='C_CONTIGUOUS'), C.c_int,
-                        # OUT
-                        np.ctypeslib.ndpointer(
-                                        dtype=np.float32, ndim=1,
-                                        flags='C_CONTIGUOUS'),
-                        C.POINTER(C.c_int)]
+# -------------------------------------------  C routines (extension)
+# The routines take any buffer-protocol object, validate shapes and
+# dtypes natively and release the GIL during the CF calculation:
+#     idx = routine(data, cf, mask=None)
+# The extension module is loaded lazily at the first CF calculation,
+# to keep `import aurem.pickers` as light as possible.
+CF_KERNELS = {"AIC": "aicp",
+              "REC": "recp"}
+_CLIB = None
+
+
+def _get_kernel(method):
+    """ Return the C routine of method, loading the extension once """
+    global _CLIB
+    if _CLIB is None:
+        _CLIB = importlib.import_module("aurem.aurem_clib")
+    return getattr(_CLIB, CF_KERNELS[method])
 # ---------------------------------------------------------------------
 
 
+def _trace_buffers(trace):
+    """ Return the float32 data and the uint8 mask (or None) of trace.
+
+    Masked arrays are not filled: the underlying data buffer is passed
+    as is, together with its mask, to the C routines.
+    """
+    data, mask = trace.data, None
+    if isinstance(data, np.ma.MaskedArray):
+        if data.mask is not np.ma.nomask and data.mask.any():
+            mask = np.ascontiguousarray(data.mask).view(np.uint8)
+        data = data.data
+    return np.ascontiguousarray(data, np.float32), mask
+
+
+def _select_segments(stream, **streamselect):
+    """ Return the time-sorted segments of the first selected trace-id
+
+    All the selected traces sharing the id of the first one are
+    considered segments of the same (gappy) recording. If the segments
+    overlap or have different sampling rates, only the first selected
+    trace is used (with a warning).
+    """
+    _sel = stream.select(**streamselect)
+    segments = sorted([tr for tr in _sel if tr.id == _sel[0].id],
+                      key=lambda tr: tr.stats.starttime)
+    for _prev, _next in zip(segments[:-1], segments[1:]):
+        if (_prev.stats.sampling_rate != _next.stats.sampling_rate or
+           _next.stats.starttime <= _prev.stats.endtime):
+            logger.warning("Segments of %s are overlapping or have "
+                           "different sampling rates: using the first "
+                           "selected trace only" % _prev.id)
+            return [_sel[0]]
+    return segments
+
+
+def _compute_cf(method, segments):
+    """ Run the C routine of method over the segments list
+
+    Wrapper around `_run_kernels` recording the call in the
+    aurem.metrics registry, when metrics are enabled.
+
+    Returns:
+        cf (np.ndarray): the characteristic function
+        idx (int): the pick index (0 if no pick found)
+
+    """
+    if not AUME.is_enabled():
+        return _run_kernels(method, segments)
+    #
+    if len(segments) > 1:
+        engine = "segmented"
+    elif np.ma.is_masked(segments[0].data):
+        engine = "masked"
+    else:
+        engine = "dense"
+    npts = sum(_seg.stats.npts for _seg in segments)
+    t0 = time.perf_counter()
+    try:
+        cf, idx = _run_kernels(method, segments)
+    except Exception:
+        AUME.observe_pick(method, engine, npts, time.perf_counter() - t0,
+                          error=True)
+        raise
+    AUME.observe_pick(method, engine, npts, time.perf_counter() - t0,
+                      picked=(idx != 0))
+    return (cf, idx)
+
+
+def _run_kernels(method, segments):
+    """ Run the C routine of method over the segments list
+
+    Only the real samples of the segments are concatenated and passed
+    to a single C-routine call (masked samples included, with their
+    mask), so that the cost doesn't depend on the gaps length. The CF
+    is then laid back on the segments time-range through their sample
+    offsets, with INFINITY inside the gaps: segmented and masked
+    (merged) inputs give the same CF and pick.
+
+    Returns:
+        cf (np.ndarray): the characteristic function
+        idx (int): the pick index (0 if no pick found)
+
+    """
+    kernel = _get_kernel(method)
+    if len(segments) == 1:
+        data, mask = _trace_buffers(segments[0])
+        cf = np.zeros(max(data.size - 1, 0), dtype=np.float32)
+        if data.size < 2:
+            return (cf, 0)
+        # if idx == 0, it means inside C routine it didn't pick
+        idx = kernel(data, cf, mask)
+        return (cf, idx)
+    #
+    start = segments[0].stats.starttime
+    delta = segments[0].stats.delta
+    offsets = [int(round((_seg.stats.starttime - start) / delta))
+               for _seg in segments]
+    buffers = [_trace_buffers(_seg) for _seg in segments]
+    sizes = [_data.size for _data, _ in buffers]
+    starts = [sum(sizes[:_ii]) for _ii in range(len(sizes))]
+    data = np.concatenate([_data for _data, _ in buffers])
+    mask = None
+    if any(_mask is not None for _, _mask in buffers):
+        mask = np.concatenate([
+                    _mask if _mask is not None else
+                    np.zeros(_data.size, dtype=np.uint8)
+                    for _data, _mask in buffers])
+    #
+    segcf = np.zeros(max(data.size - 1, 0), dtype=np.float32)
+    segidx = kernel(data, segcf, mask) if data.size >= 2 else 0
+    # Back to the time-range: CF[ii] refers to the ii-th real sample
+    cf = np.full(max(offsets[-1] + sizes[-1] - 1, 0), np.inf,
+                 dtype=np.float32)
+    idx = 0
+    for _off, _start, _size in zip(offsets, starts, sizes):
+        _nn = max(min(_size, segcf.size - _start), 0)
+        cf[_off:_off + _nn] = segcf[_start:_start + _nn]
+        if _start <= segidx < _start + _size:
+            idx = _off + (segidx - _start)
+    return (cf, idx)
+
+
 class REC(object):
     """ Initialize the Reciprocal-Based picker class.
 
@@ -63,6 +175,9 @@ class REC(object):
     Note:
         If no query key-args given, the class will set the
         working trace as the 1st stream-trace !!!
+        All the selected traces sharing the working trace id are
+        picked together as segments of a gappy recording, with gaps
+        treated as masked samples (see `set_working_trace`).
 
     References:
         Ramin Madarshahian, Paul Ziehl, and Michael D. Todd (2020),
@@ -73,6 +188,7 @@ class REC(object):
     """
     def __init__(self, stream, **streamselect):
         self.wt = None  # just to define variable --> set_working_trace
+        self.segments = None
         self.st = stream.copy()
         self.set_working_trace(**streamselect)
         #
@@ -91,16 +207,7 @@ class REC(object):
 
         """
         if self.wt:
-            pminidx = C.c_int()
-            tmparr = np.ascontiguousarray(self.wt.data, np.float32)
-            self.recfn = np.zeros(self.wt.data.size - 1,
-                                  dtype=np.float32, order="C")
-            ret = myclib.recp(tmparr, self.wt.data.size,
-                              self.recfn, C.byref(pminidx))
-            if ret != 0:
-                raise MemoryError("Something wrong with REC picker C-routine")
-            #
-            self.idx = pminidx.value
+            self.recfn, self.idx = _compute_cf("REC", self.segments)
             if self.idx != 0 and isinstance(self.idx, int):
                 # pick found
                 logger.debug("REC found pick")
@@ -123,12 +230,18 @@ class REC(object):
         Note:
             If no query key-args given, the class will set the
             working trace as the 1st stream-trace !!!
+            The other selected traces with the same id are kept as
+            segments of the working trace (`segments` attribute), and
+            `wt` is the earliest one. Overlapping segments or segments
+            with different sampling rates are not supported: in that
+            case only the 1st selected trace is used.
 
         """
         if streamselect and not isinstance(streamselect, dict):
             raise TypeError("Please specify stream select key-args query!")
         #
-        self.wt = self.st.select(**streamselect)[0]
+        self.segments = _select_segments(self.st, **streamselect)
+        self.wt = self.segments[0]
 
     def get_rec_function(self, mode="real"):
         """ Return the REC charachteristic function.
@@ -196,6 +309,7 @@ class REC(object):
             ax (matplotlib.pyplot.axes): axis object of the plot
 
         """
+        from aurem import plotting as AUPL  # lazy: matplotlib is heavy
         ax = AUPL.plot_rec(self,
                            plot_ax=None,
                            plot_cf=True,
@@ -230,6 +344,9 @@ class AIC(object):
     Note:
         If no query key-args given, the class will set the
         working trace as the 1st stream-trace !!!
+        All the selected traces sharing the working trace id are
+        picked together as segments of a gappy recording, with gaps
+        treated as masked samples (see `set_working_trace`).
 
     References:
         Maeda, Naoki. 1985. “A Method for Reading and Checking Phase
@@ -241,6 +358,7 @@ class AIC(object):
     """
     def __init__(self, stream, **streamselect):
         self.wt = None  # just to define variable --> set_working_trace
+        self.segments = None
         self.st = stream.copy()
         self.set_working_trace(**streamselect)
         #
@@ -259,16 +377,7 @@ class AIC(object):
 
         """
         if self.wt:
-            pminidx = C.c_int()
-            tmparr = np.ascontiguousarray(self.wt.data, np.float32)
-            self.aicfn = np.zeros(self.wt.data.size - 1,
-                                  dtype=np.float32, order="C")
-            ret = myclib.aicp(tmparr, self.wt.data.size,
-                              self.aicfn, C.byref(pminidx))
-            if ret != 0:
-                raise MemoryError("Something wrong with AIC picker C-routine")
-            #
-            self.idx = pminidx.value
+            self.aicfn, self.idx = _compute_cf("AIC", self.segments)
             if self.idx != 0 and isinstance(self.idx, int):
                 # pick found
                 logger.debug("AIC found pick")
@@ -290,13 +399,19 @@ class AIC(object):
 
         Note:
             After the selection-query stace of class stream. It will
-            select the first trace of filtered stream
+            select the first trace of filtered stream.
+            The other selected traces with the same id are kept as
+            segments of the working trace (`segments` attribute), and
+            `wt` is the earliest one. Overlapping segments or segments
+            with different sampling rates are not supported: in that
+            case only the 1st selected trace is used.
 
         """
         if streamselect and not isinstance(streamselect, dict):
             raise TypeError("Please specify stream select key-args query!")
         #
-        self.wt = self.st.select(**streamselect)[0]
+        self.segments = _select_segments(self.st, **streamselect)
+        self.wt = self.segments[0]
 
     def get_aic_function(self, mode="real"):
         """ Return the AIC charachteristic function.
@@ -371,6 +486,7 @@ class AIC(object):
             ax (matplotlib.pyplot.axes): axis object of the plot
 
         """
+        from aurem import plotting as AUPL  # lazy: matplotlib is heavy
         ax = AUPL.plot_aic(self,
                            plot_ax=None,
                            plot_cf=True,
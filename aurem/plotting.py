@@ -2,6 +2,7 @@ import copy
 import numpy as np
 import logging
 import matplotlib.pyplot as plt
+from obspy import Stream
 plt.style.context('fivethirtyeight')
 
 
@@ -20,17 +21,52 @@ def _normalize_trace(workList, rangeVal=[-1, 1]):
         rangeVal (list, tuple): min and max range of normalization
 
     Returns:
-        worklist (np.ndarray, list, tuple): normalized input array.
+        worklist (np.ndarray): normalized input array. NaN values
+            (e.g. gaps) are ignored and kept as NaN.
 
     """
-    minVal = min(workList)
-    maxVal = max(workList)
-    workList[:] = [((x - minVal) / (maxVal - minVal)) *
-                   (rangeVal[1] - rangeVal[0]) for x in workList]
+    workList = np.asarray(workList, dtype=np.float64)
+    minVal = np.nanmin(workList)
+    maxVal = np.nanmax(workList)
+    workList = ((workList - minVal) / (maxVal - minVal) *
+                (rangeVal[1] - rangeVal[0]))
     workList = workList + rangeVal[0]
     return workList
 
 
+def _working_trace_data(pick_obj):
+    """Return time vector and data of the picker working trace
+
+    The (optional) segments of the working trace are merged over their
+    whole time-range, with NaN in the gaps. Masked samples are NaN too.
+
+    Inputs:
+        pick_obj (aurem.picker.AIC, aurem.picker.REC): picker object
+
+    Returns:
+        tv (np.ndarray): time vector relative to the working trace start
+        td (np.ndarray): float data array
+
+    """
+    segments = getattr(pick_obj, "segments", None) or [pick_obj.wt]
+    newTrace = Stream(traces=[_seg.copy() for _seg in segments]).merge()[0]
+    tv = newTrace.times()
+    td = np.ma.filled(np.ma.masked_array(newTrace.data, dtype=np.float64),
+                      np.nan)
+    return (tv, td)
+
+
+def _plottable_cf(cf):
+    """ Return a copy of the CF with INF values (edges, gaps) as NaN """
+    _wa = copy.deepcopy(cf)
+    # GoingToC: replace INF at the start and end with adiacent
+    #           values for plotting reasons
+    _wa[0] = _wa[1]
+    _wa[-1] = _wa[-2]
+    _wa[np.isinf(_wa)] = np.nan
+    return _wa
+
+
 # =======================  Main
 
 def plot_rec(rec_obj,
@@ -66,10 +102,8 @@ def plot_rec(rec_obj,
     else:
         inax = plot_ax
 
-    # Creating time vector and trace data
-    newTrace = rec_obj.wt.copy()
-    tv = newTrace.times()
-    td = newTrace.data
+    # Creating time vector and trace data (gaps as NaN)
+    tv, td = _working_trace_data(rec_obj)
 
     if normalize:
         td = _normalize_trace(td, rangeVal=[-1, 1])
@@ -77,14 +111,9 @@ def plot_rec(rec_obj,
     # -------------------------- Carachteristic function
     if plot_cf:
         if rec_obj.recfn.any():
-            _wa = copy.deepcopy(rec_obj.recfn)
-            # GoingToC: replace INF at the start and end with adiacent
-            #           values for plotting reasons
-            _wa[0] = _wa[1]
-            _wa[-1] = _wa[-2]
-
+            _tmp = _plottable_cf(rec_obj.recfn)
             if normalize:
-                _tmp = _normalize_trace(_wa, rangeVal=[0, 1])
+                _tmp = _normalize_trace(_tmp, rangeVal=[0, 1])
             #
             zeropad = len(td) - len(_tmp)
             #
@@ -170,10 +199,8 @@ def plot_aic(aic_obj,
     else:
         inax = plot_ax
 
-    # Creating time vector and trace data
-    newTrace = aic_obj.wt.copy()
-    tv = newTrace.times()
-    td = newTrace.data
+    # Creating time vector and trace data (gaps as NaN)
+    tv, td = _working_trace_data(aic_obj)
 
     if normalize:
         td = _normalize_trace(td, rangeVal=[-1, 1])
@@ -181,14 +208,9 @@ def plot_aic(aic_obj,
     # -------------------------- Carachteristic function
     if plot_cf:
         if aic_obj.aicfn.any():
-            _wa = copy.deepcopy(aic_obj.aicfn)
-            # GoingToC: replace INF at the start and end with adiacent
-            #           values for plotting reasons
-            _wa[0] = _wa[1]
-            _wa[-1] = _wa[-2]
-
+            _tmp = _plottable_cf(aic_obj.aicfn)
             if normalize:
-                _tmp = _normalize_trace(_wa, rangeVal=[0, 1])
+                _tmp = _normalize_trace(_tmp, rangeVal=[0, 1])
             #
             zeropad = len(td) - len(_tmp)
             #
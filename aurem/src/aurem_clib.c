@@ -1,5 +1,9 @@
-// gcc -shared -Wl,-soname,aurem_c -O3 -o aurem_c.so -fPIC aurem_c.c
+// Python extension module `aurem.aurem_clib`, built by setup.py
+// (in place: python setup.py build_ext --inplace)
 
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <limits.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <math.h>
@@ -9,12 +13,22 @@
 
 int aicp(float* arr, int sz, /*@out@*/ float* aic, int* pminidx);
 int recp(float *arr, int sz, /*@out@*/ float* rec, int* pminidx);
+int aicpm(float* arr, unsigned char* mask, int sz,
+          /*@out@*/ float* aic, int* pminidx);
+int recpm(float* arr, unsigned char* mask, int sz,
+          /*@out@*/ float* rec, int* pminidx);
 
 
 
 /* ------------
 AIC(k)=k*log(variance(x[1,k]))+(n-k-1)*log(variance(x[k+1,n]))
 REC(k_i)= -k / variance(x[1,k]) - (n-k) / variance(x[k+1,n]))
+
+MASK: the *pm variants take an additional mask array (non-zero for
+masked/gap samples). Masked samples are skipped in the moments
+accumulation (k and n-k become the number of valid samples on each
+side) and the CF is set to INFINITY on masked samples, so that the
+pick can never fall inside a gap. A NULL mask means no masked samples.
 -------------- */
 
 //
@@ -23,6 +37,12 @@ REC(k_i)= -k / variance(x[1,k]) - (n-k) / variance(x[k+1,n]))
 
 
 int aicp(float* arr, int sz, /*@out@*/ float* aic, int* pminidx) {
+    return aicpm(arr, NULL, sz, aic, pminidx);
+}
+
+
+int aicpm(float* arr, unsigned char* mask, int sz,
+          /*@out@*/ float* aic, int* pminidx) {
 
     // Declare MAIN
     int ii;  // MAIN loop
@@ -40,6 +60,7 @@ int aicp(float* arr, int sz, /*@out@*/ float* aic, int* pminidx) {
     float devTwo, sdevTwo;
     //
     float valOne, valTwo;
+    int nOne, nTwo;  // valid samples
 
 
     // Work
@@ -47,37 +68,45 @@ int aicp(float* arr, int sz, /*@out@*/ float* aic, int* pminidx) {
 
         // Loop for VAR 1
         sumOne = 0.0;
+        nOne = 0;
         for (_x=0; _x<ii; _x++){
+            if (mask && mask[_x]) continue;
             sumOne = sumOne + arr[_x];
+            nOne++;
         }
-        meanOne = sumOne / ii;
+        meanOne = sumOne / nOne;
 
         sdevOne = 0.0;
         for (_xx=0; _xx<ii; _xx++){
+            if (mask && mask[_xx]) continue;
             devOne = (arr[_xx] - meanOne) * (arr[_xx] - meanOne);
             sdevOne = sdevOne + devOne;
         }
         //var1 = sdevOne / ii;
         //sd = sqrt(var1);
-        valOne = ii * log(sdevOne / ii);
+        valOne = nOne * log(sdevOne / nOne);
 
 
 
         // Loop for VAR 2
         sumTwo = 0.0;
+        nTwo = 0;
         for (_y=ii; _y<sz; _y++){
+            if (mask && mask[_y]) continue;
             sumTwo = sumTwo + arr[_y];
+            nTwo++;
         }
-        meanTwo = sumTwo / (sz - ii);
+        meanTwo = sumTwo / nTwo;
 
         sdevTwo = 0.0;
         for (_yy=ii; _yy<sz; _yy++){
+            if (mask && mask[_yy]) continue;
             devTwo = (arr[_yy] - meanTwo) * (arr[_yy] - meanTwo);
             sdevTwo = sdevTwo + devTwo;
         }
         //var2 = sdevTwo / (sz - ii);
         //sd = sqrt(var2);
-        valTwo = (sz - ii - 1) * log(sdevTwo / (sz - ii));
+        valTwo = (nTwo - 1) * log(sdevTwo / nTwo);
 
         // Allocate to AIC
         aic[ii - 1] = (valOne + valTwo);
@@ -92,6 +121,10 @@ int aicp(float* arr, int sz, /*@out@*/ float* aic, int* pminidx) {
             aic[ii-1] = INFINITY;
         }
 
+        if ( mask && mask[ii-1] ) {
+            aic[ii-1] = INFINITY;
+        }
+
 
         // Not minor equal, but just minor
         if (aic[ii-1] < minval) {
@@ -110,6 +143,13 @@ int aicp(float* arr, int sz, /*@out@*/ float* aic, int* pminidx) {
 //
 
 int recp(float *arr, int sz, /*@out@*/ float* rec, int* pminidx)
+{
+    return recpm(arr, NULL, sz, rec, pminidx);
+}
+
+
+int recpm(float* arr, unsigned char* mask, int sz,
+          /*@out@*/ float* rec, int* pminidx)
 {
 
     // Declare MAIN
@@ -127,6 +167,7 @@ int recp(float *arr, int sz, /*@out@*/ float* rec, int* pminidx)
     float devTwo, sdevTwo;
     //
     float valOne, valTwo;
+    int nOne, nTwo;  // valid samples
 
 
     // Work
@@ -134,37 +175,45 @@ int recp(float *arr, int sz, /*@out@*/ float* rec, int* pminidx)
 
         // Loop for VAR 1
         sumOne = 0.0;
+        nOne = 0;
         for (_x=0; _x<ii; _x++){
+            if (mask && mask[_x]) continue;
             sumOne = sumOne + arr[_x];
+            nOne++;
         }
-        meanOne = sumOne / ii;
+        meanOne = sumOne / nOne;
 
         sdevOne = 0.0;
         for (_xx=0; _xx<ii; _xx++){
+            if (mask && mask[_xx]) continue;
             devOne = (arr[_xx] - meanOne) * (arr[_xx] - meanOne);
             sdevOne = sdevOne + devOne;
         }
         //var1 = sdevOne / ii;
         //sd = sqrt(var1);
-        valOne = -ii / (sdevOne/ii);
+        valOne = -nOne / (sdevOne / nOne);
 
 
 
         // Loop for VAR 2
         sumTwo = 0.0;
+        nTwo = 0;
         for (_y=ii; _y<sz; _y++){
+            if (mask && mask[_y]) continue;
             sumTwo = sumTwo + arr[_y];
+            nTwo++;
         }
-        meanTwo = sumTwo / (sz - ii);
+        meanTwo = sumTwo / nTwo;
 
         sdevTwo = 0.0;
         for (_yy=ii; _yy<sz; _yy++){
+            if (mask && mask[_yy]) continue;
             devTwo = (arr[_yy] - meanTwo) * (arr[_yy] - meanTwo);
             sdevTwo = sdevTwo + devTwo;
         }
         //var2 = sdevTwo / (sz - ii);
         //sd = sqrt(var2);
-        valTwo = -(sz - ii) / (sdevTwo / (sz - ii));
+        valTwo = -nTwo / (sdevTwo / nTwo);
 
 
         // Allocate to REC
@@ -179,6 +228,10 @@ int recp(float *arr, int sz, /*@out@*/ float* rec, int* pminidx)
             rec[ii-1] = INFINITY;
         }
 
+        if ( mask && mask[ii-1] ) {
+            rec[ii-1] = INFINITY;
+        }
+
         // Not minor equal, but just minor
         if (rec[ii-1] < minval) {
             minval = rec[ii-1];
@@ -191,6 +244,184 @@ int recp(float *arr, int sz, /*@out@*/ float* rec, int* pminidx)
 }
 
 
+//
+//  PYTHON - Extension module interface
+//
+//  All the routines take buffer-protocol objects (e.g. np.ndarray,
+//  array.array, memoryview) that are validated here, the GIL is
+//  released while the CF is computed.
+//
+
+static int check_buffer(Py_buffer* view, const char* name, char fmt,
+                        Py_ssize_t size)
+{
+    // NULL format means unsigned bytes ("B") in the buffer protocol
+    const char* format = view->format ? view->format : "B";
+    const char* _fmt = format;
+    char _native = (*(const char*)&(int){1}) ? '<' : '>';
+
+    if (view->ndim != 1) {
+        PyErr_Format(PyExc_ValueError,
+                     "%s must be a 1-D array (got %d dimensions)",
+                     name, view->ndim);
+        return -1;
+    }
+    if (_fmt[0] == '@' || _fmt[0] == '=' || _fmt[0] == _native) {
+        _fmt++;
+    }
+    if ( !((_fmt[0] == fmt || (fmt == 'B' && _fmt[0] == '?')) &&
+           _fmt[1] == '\0') ) {
+        PyErr_Format(PyExc_TypeError,
+                     "%s has wrong dtype (buffer format '%s', "
+                     "expected '%c')", name, format, fmt);
+        return -1;
+    }
+    if (size >= 0 && view->shape[0] != size) {
+        PyErr_Format(PyExc_ValueError,
+                     "%s must have %zd elements (got %zd)",
+                     name, size, view->shape[0]);
+        return -1;
+    }
+    return 0;
+}
+
+
+typedef int (*cf_routine)(float*, unsigned char*, int, float*, int*);
+
+
+static PyObject* run_cf(cf_routine routine, const char* cfname,
+                        PyObject* args, PyObject* kwargs)
+{
+    static char* kwlist[] = {"data", "cf", "mask", NULL};
+    PyObject *dataobj, *cfobj, *maskobj = Py_None;
+    Py_buffer data, cf, mask;
+    int sz, pminidx = 0, ret;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|O", kwlist,
+                                     &dataobj, &cfobj, &maskobj)) {
+        return NULL;
+    }
+    if (PyObject_GetBuffer(dataobj, &data,
+                           PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) < 0) {
+        return NULL;
+    }
+    if (check_buffer(&data, "data", 'f', -1) < 0) {
+        PyBuffer_Release(&data);
+        return NULL;
+    }
+    if (data.shape[0] < 2 || data.shape[0] > INT_MAX) {
+        PyErr_Format(PyExc_ValueError,
+                     "data must have between 2 and %d elements (got %zd)",
+                     INT_MAX, data.shape[0]);
+        PyBuffer_Release(&data);
+        return NULL;
+    }
+    sz = (int)data.shape[0];
+    if (PyObject_GetBuffer(cfobj, &cf, PyBUF_C_CONTIGUOUS |
+                           PyBUF_FORMAT | PyBUF_WRITABLE) < 0) {
+        PyBuffer_Release(&data);
+        return NULL;
+    }
+    if (check_buffer(&cf, "cf", 'f', sz - 1) < 0) {
+        PyBuffer_Release(&cf);
+        PyBuffer_Release(&data);
+        return NULL;
+    }
+    mask.buf = NULL;
+    if (maskobj != Py_None) {
+        if (PyObject_GetBuffer(maskobj, &mask,
+                               PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) < 0) {
+            PyBuffer_Release(&cf);
+            PyBuffer_Release(&data);
+            return NULL;
+        }
+        if (check_buffer(&mask, "mask", 'B', sz) < 0) {
+            PyBuffer_Release(&mask);
+            PyBuffer_Release(&cf);
+            PyBuffer_Release(&data);
+            return NULL;
+        }
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    ret = routine((float*)data.buf, (unsigned char*)mask.buf, sz,
+                  (float*)cf.buf, &pminidx);
+    Py_END_ALLOW_THREADS
+
+    if (maskobj != Py_None) {
+        PyBuffer_Release(&mask);
+    }
+    PyBuffer_Release(&cf);
+    PyBuffer_Release(&data);
+    if (ret != 0) {
+        PyErr_Format(PyExc_MemoryError,
+                     "Something wrong with %s picker C-routine", cfname);
+        return NULL;
+    }
+    return PyLong_FromLong(pminidx);
+}
+
+
+static PyObject* py_aicp(PyObject* self, PyObject* args, PyObject* kwargs)
+{
+    (void)self;  // unused: module-level function
+    return run_cf(aicpm, "AIC", args, kwargs);
+}
+
+
+static PyObject* py_recp(PyObject* self, PyObject* args, PyObject* kwargs)
+{
+    (void)self;  // unused: module-level function
+    return run_cf(recpm, "REC", args, kwargs);
+}
+
+
+PyDoc_STRVAR(aicp_doc,
+"aicp(data, cf, mask=None)\n--\n\n"
+"Compute the AIC characteristic function of data into cf.\n\n"
+"Args:\n"
+"    data (float32 buffer): 1-D C-contiguous input samples\n"
+"    cf (float32 buffer): writable 1-D output of data.size - 1 elements\n"
+"    mask (uint8/bool buffer): optional, non-zero on masked samples\n\n"
+"Returns:\n"
+"    idx (int): index of the CF minimum (0 if no pick found)\n");
+
+PyDoc_STRVAR(recp_doc,
+"recp(data, cf, mask=None)\n--\n\n"
+"Compute the REC characteristic function of data into cf.\n\n"
+"Args:\n"
+"    data (float32 buffer): 1-D C-contiguous input samples\n"
+"    cf (float32 buffer): writable 1-D output of data.size - 1 elements\n"
+"    mask (uint8/bool buffer): optional, non-zero on masked samples\n\n"
+"Returns:\n"
+"    idx (int): index of the CF minimum (0 if no pick found)\n");
+
+
+static PyMethodDef aurem_clib_methods[] = {
+    {"aicp", (PyCFunction)(void(*)(void))py_aicp,
+     METH_VARARGS | METH_KEYWORDS, aicp_doc},
+    {"recp", (PyCFunction)(void(*)(void))py_recp,
+     METH_VARARGS | METH_KEYWORDS, recp_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+
+static struct PyModuleDef aurem_clib_module = {
+    PyModuleDef_HEAD_INIT,
+    "aurem_clib",
+    "C routines of the AUREM pickers",
+    -1,
+    aurem_clib_methods,
+    NULL, NULL, NULL, NULL
+};
+
+
+PyMODINIT_FUNC PyInit_aurem_clib(void)
+{
+    return PyModule_Create(&aurem_clib_module);
+}
+
+
 /* AIC[ii]
 var1 = np.log(np.var(arr[0:ii]))
 var2 = np.log(np.var(arr[ii:]))
@@ -7,7 +7,7 @@ with open("requirements.txt") as f:
     required_list = f.read().splitlines()
 
 
-cmodule = Extension('aurem/src/aurem_clib',
+cmodule = Extension('aurem.aurem_clib',
                     sources=['aurem/src/aurem_clib.c'],
                     extra_compile_args=["-O3"])
 
@@ -22,6 +22,7 @@ setup(
     url="https://github.com/mbagagli/aurem",
     python_requires='>=3.6',
     install_requires=required_list,
+    extras_require={"arrow": ["pyarrow"]},
     packages=find_packages(),
     package_data={"aurem": ['src/*.c']},
     include_package_data=True,
@@ -32,7 +33,12 @@ setup(
         "Operating System :: MacOS",
         "Intended Audience :: Science/Research",
     ],
-    ext_modules=[cmodule]
+    ext_modules=[cmodule],
+    entry_points={
+        "console_scripts": [
+            "aurem-pick=aurem.cli:main",
+        ],
+    },
 )
 
 
@@ -1,3 +1,5 @@
+import pytest
+import numpy as np
 from aurem.pickers import REC, AIC
 from obspy import read, UTCDateTime
 
@@ -60,3 +62,391 @@ def test_aurem_aic():
         errors.append("PickTime IDX do not match!")
     #
     assert not errors, "Errors occured:\n{}".format("\n".join(errors))
+
+
+def test_aurem_batch_cli(tmp_path):
+    """ Test the aurem-pick entry point aganist obspy.read() Z channel
+    """
+    import csv
+    from aurem.cli import main
+    from aurem.batch import BatchStats, FileResult
+    #
+    datadir = tmp_path / "station,with,commas"
+    datadir.mkdir()
+    read().write(str(datadir / "example.mseed"), format="MSEED")
+    configfile = tmp_path / "picking.ini"
+    configfile.write_text("[select]\nchannel = *Z\n\n"
+                          "[filter]\ntype = highpass\nfreq = 2\n"
+                          "corners = 4\n\n"
+                          "[trim]\nstart_offset = 1\n"
+                          "endtime = 2009-08-24T00:20:11\n")
+    outfile = tmp_path / "picks.csv"
+
+    # Run
+    ret = main([str(datadir / "*.mseed"), "--method", "aic",
+                "--config", str(configfile), "--workers", "2",
+                "--output", str(outfile), "--quiet"])
+
+    # --- Test
+    with open(str(outfile), newline="") as IN:
+        lines = list(csv.reader(IN))
+    assert ret == 0
+    assert len(lines) == 2
+    fields = lines[1]
+    assert fields[0] == str(datadir / "example.mseed")
+    assert fields[1] == "BW.RJOB..EHZ"
+    assert UTCDateTime(fields[3]) == UTCDateTime("2009-08-24T00:20:07.700000")
+    assert int(fields[4]) == 370
+
+    # --- Failed traces are reported in the statistics
+    stats = BatchStats()
+    stats.update(FileResult("example.mseed", [], None, 2, None))
+    assert stats.failed_traces == 2
+    assert "2 failed" in stats.summary().splitlines()[1]
+
+
+def test_aurem_batch_config(tmp_path):
+    """ Test the batch config parsing and the CLI config errors
+    """
+    from aurem.batch import load_config
+    from aurem.cli import main
+    #
+    configfile = tmp_path / "picking.ini"
+    configfile.write_text("[select]\nstation = 0123\nlocation = 00\n\n"
+                          "[filter]\ntype = highpass\nfreq = 2\n")
+    config = load_config(str(configfile))
+    assert config["select"] == {"station": "0123", "location": "00"}
+    assert config["filter"] == {"type": "highpass", "freq": 2}
+
+    # --- Config errors: exit code 2, no traceback
+    read().write(str(tmp_path / "example.mseed"), format="MSEED")
+    badfile = tmp_path / "bad.ini"
+    badfile.write_text("[filter]\nfreq = 2\n")
+    for _cfg in (str(badfile), str(tmp_path / "missing.ini")):
+        assert main([str(tmp_path / "example.mseed"), "--config", _cfg,
+                     "--quiet"]) == 2
+
+
+def test_aurem_batch_columnar(tmp_path):
+    """ Test the columnar batch output aganist obspy.read() Z channel
+    """
+    from aurem.batch import (pick_columnar, write_picks, pick_dtype,
+                             concatenate_picks, picks_to_arrow, NO_PICK_NS,
+                             PICK_DTYPE)
+    #
+    read().write(str(tmp_path / "example.mseed"), format="MSEED")
+    config = {"select": {"channel": "*Z"},
+              "filter": {"type": "highpass", "freq": 2, "corners": 4},
+              "trim": {"start_offset": 1,
+                       "endtime": "2009-08-24T00:20:11"}}
+
+    # Run
+    picks = pick_columnar([str(tmp_path / "example.mseed")],
+                          method="rec", config=config)
+
+    # --- Test
+    assert picks.size == 1
+    assert picks["file"][0] == str(tmp_path / "example.mseed")
+    assert picks["id"][0] == "BW.RJOB..EHZ"
+    assert picks["pick_ns"][0] != NO_PICK_NS
+    assert picks["pick_ns"][0] == UTCDateTime(
+                                    "2009-08-24T00:20:07.700000").ns
+    assert picks["index"][0] == 370
+
+    # --- Parquet
+    pq = pytest.importorskip("pyarrow.parquet")
+    write_picks(picks, str(tmp_path / "picks.parquet"), fmt="parquet")
+    table = pq.read_table(str(tmp_path / "picks.parquet"))
+    assert table.num_rows == 1
+    assert table.column("index").to_pylist() == [370]
+
+    # --- Long ids (no truncation) and no-pick rows
+    longid = "FDSN:XX_STATIONLONG_00_H_H_Z" * 2
+    nopick = np.array([("other.mseed", longid, NO_PICK_NS, 0, np.inf, 10)],
+                      dtype=pick_dtype(11, len(longid)))
+    allpicks = concatenate_picks([picks, nopick])
+    assert allpicks["id"][1] == longid
+    assert allpicks["id"][0] == "BW.RJOB..EHZ"
+    # default layout safe for long ids, shrunk to the data when merged
+    user = np.zeros(1, dtype=PICK_DTYPE)
+    user["id"] = longid
+    assert user["id"][0] == longid
+    merged = concatenate_picks([user, picks])
+    assert merged["id"][0] == longid
+    assert merged.dtype["id"] == np.dtype("U%d" % len(longid))
+    assert picks_to_arrow(allpicks).column("pick").to_pylist()[1] is None
+
+    # --- Feather
+    feather = pytest.importorskip("pyarrow.feather")
+    write_picks(allpicks, str(tmp_path / "picks.feather"), fmt="feather")
+    table = feather.read_table(str(tmp_path / "picks.feather"))
+    assert table.num_rows == 2
+    assert table.column("id").to_pylist() == ["BW.RJOB..EHZ", longid]
+    assert table.column("file").to_pylist()[1] == "other.mseed"
+    assert table.column("pick").null_count == 1
+
+
+def test_aurem_masked_segments():
+    """ Test masked and multi-segment traces aganist obspy.read() Z
+    """
+    st = read()
+    st.filter('highpass', freq=2, corners=4)
+    st.trim(st[0].stats.starttime + 1, UTCDateTime("2009-08-24T00:20:11"))
+    tr = st.select(channel="*Z")[0]
+
+    # --- Masked: the fill values must not change the CF
+    cfs, idxs = [], []
+    for fill in (0.0, 1e9):
+        mtr = tr.copy()
+        mtr.data = np.ma.masked_array(tr.data.copy())
+        mtr.data[100:150] = np.ma.masked
+        mtr.data.data[100:150] = fill
+        aicobj = AIC(st.__class__(traces=[mtr]))
+        aicobj.work()
+        cfs.append(aicobj.get_aic_function())
+        idxs.append(aicobj.get_pick_index())
+    assert idxs[0] == idxs[1]
+    assert not 100 <= idxs[0] < 150
+    assert np.array_equal(cfs[0], cfs[1])
+    assert np.isinf(cfs[0][100:150]).all()
+
+    # --- Segmented: no merge, gaps treated as masked samples
+    segs = st.__class__(traces=[tr.slice(endtime=tr.stats.starttime + 2),
+                                tr.slice(starttime=tr.stats.starttime + 3)])
+    recobj = REC(segs)
+    recobj.work()
+    cf = recobj.get_rec_function()
+    assert cf.size == tr.stats.npts - 1
+    assert np.isinf(cf[201:300]).all()
+    assert not 201 <= recobj.get_pick_index() < 300
+    assert recobj.get_pick() == (tr.stats.starttime +
+                                 tr.stats.delta * recobj.get_pick_index())
+    # same CF and pick of the equivalent masked trace
+    mtr = tr.copy()
+    mtr.data = np.ma.masked_array(tr.data.copy())
+    mtr.data[201:300] = np.ma.masked
+    recmask = REC(st.__class__(traces=[mtr]))
+    recmask.work()
+    assert np.array_equal(recmask.get_rec_function(), cf)
+    assert recmask.get_pick_index() == recobj.get_pick_index()
+
+    # --- Overlapping segments: old behaviour, 1st selected trace only
+    overlap = st.__class__(traces=[tr.copy(), tr.slice(
+                                        starttime=tr.stats.starttime + 3)])
+    aicobj = AIC(overlap)
+    assert aicobj.segments == [aicobj.wt]
+    assert aicobj.wt.stats.npts == tr.stats.npts
+
+
+def test_aurem_segments_onset_in_short_segment(tmp_path):
+    """ Test a segmented trace with the onset in the shorter segment
+    """
+    from obspy import Trace, Stream
+    from aurem.batch import pick_file
+    #
+    rng = np.random.RandomState(42)
+    noise = Trace(data=rng.normal(size=3000).astype(np.float32),
+                  header={"sampling_rate": 100.0})
+    onset = rng.normal(size=400).astype(np.float32)
+    onset[200:] *= 10
+    onset = Trace(data=onset, header={"sampling_rate": 100.0,
+                                      "starttime": noise.stats.endtime + 1})
+    offset = 3000 + 99  # 99 missing samples in the gap
+    # Reference: the same samples as a single gap-free (dense) trace
+    dense = Trace(data=np.concatenate([noise.data, onset.data]),
+                  header={"sampling_rate": 100.0})
+    refidx = {}
+    for picker in (AIC, REC):
+        pref = picker(Stream(traces=[dense]))
+        pref.work()
+        refidx[picker] = pref.idx
+        assert pref.idx > 3000  # onset segment, not a noise edge
+        #
+        pobj = picker(Stream(traces=[noise, onset]))
+        pobj.work()
+        assert pobj.idx - offset == pref.idx - 3000
+        assert abs(pobj.get_pick() - (onset.stats.starttime + (
+                        (pobj.idx - offset) * onset.stats.delta))) < 1e-6
+        # Long gap (1 hour): only the real samples are processed
+        late = onset.copy()
+        late.stats.starttime += 3600
+        pobj = picker(Stream(traces=[noise, late]))
+        pobj.work()
+        assert pobj.idx - (offset + 360000) == pref.idx - 3000
+        cf = pobj.recfn if picker is REC else pobj.aicfn
+        assert np.isinf(cf[3000:offset + 360000]).all()
+
+    # --- Batch: gappy file picked as a single recording
+    Stream(traces=[noise, onset]).write(str(tmp_path / "gappy.mseed"),
+                                        format="MSEED")
+    picks = pick_file(str(tmp_path / "gappy.mseed"), method="aic",
+                      columnar=True)
+    assert picks.size == 1
+    assert picks["index"][0] - offset == refidx[AIC] - 3000
+    assert picks["npts"][0] == 3400
+
+
+def test_aurem_plot_segments():
+    """ Test plotting of masked and segmented pickers
+    """
+    matplotlib = pytest.importorskip("matplotlib")
+    matplotlib.use("Agg")
+    from aurem import plotting
+    #
+    st = read()
+    st.filter('highpass', freq=2, corners=4)
+    tr = st.select(channel="*Z")[0]
+    segs = st.__class__(traces=[tr.slice(endtime=tr.stats.starttime + 5),
+                                tr.slice(starttime=tr.stats.starttime + 6)])
+    recobj = REC(segs)
+    recobj.work()
+    aicobj = AIC(segs)
+    aicobj.work()
+    #
+    ax = plotting.plot_rec(recobj, plot_cf=True)
+    cfline = [_ll for _ll in ax.get_lines() if _ll.get_label() == "CF"][0]
+    assert np.nanmax(cfline.get_ydata()) == 1.0
+    assert len(cfline.get_xdata()) == tr.stats.npts
+    plotting.plot_aic(aicobj, plot_cf=True)
+
+
+def test_aurem_clib_extension():
+    """ Test the C extension routines, validation and thread-safety
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from aurem import aurem_clib
+    #
+    st = read()
+    st.filter('highpass', freq=2, corners=4)
+    st.trim(st[0].stats.starttime + 1, UTCDateTime("2009-08-24T00:20:11"))
+    data = np.ascontiguousarray(st.select(channel="*Z")[0].data, np.float32)
+
+    # --- Buffer protocol: same result of the pickers classes
+    cf = np.zeros(data.size - 1, dtype=np.float32)
+    assert aurem_clib.aicp(data, cf) == 370
+    assert aurem_clib.recp(memoryview(data), cf) == 370
+
+    # --- Native validation
+    with pytest.raises(TypeError):
+        aurem_clib.aicp(data.astype(np.float64), cf)
+    with pytest.raises(ValueError):
+        aurem_clib.aicp(data, cf[:-1])
+    with pytest.raises(ValueError):
+        aurem_clib.aicp(data, cf, mask=np.zeros(3, dtype=np.uint8))
+
+    # --- Thread pool (GIL released)
+    def _pick(_):
+        return aurem_clib.aicp(data, np.zeros(data.size - 1, np.float32))
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        assert set(pool.map(_pick, range(8))) == {370}
+
+
+# Maximum time (s) spent importing the aurem modules, on top of the
+# numpy and obspy imports (regression benchmark for lazy loading).
+IMPORT_TIME_BUDGET = 0.25
+
+_IMPORT_BENCH = """
+import sys, time
+import numpy, obspy
+_before = set(sys.modules)
+_t0 = time.perf_counter()
+import aurem.pickers, aurem.batch, aurem.cli
+_dt = time.perf_counter() - _t0
+_new = set(sys.modules) - _before
+print(_dt, any(_mm.split('.')[0] == 'matplotlib' for _mm in _new),
+      'aurem.aurem_clib' in _new)
+"""
+
+
+def test_aurem_import_time():
+    """ Test that importing aurem is fast and does not load matplotlib
+    """
+    import sys
+    import subprocess
+    #
+    timings = []
+    for _ in range(3):
+        # Fresh interpreter each time, best of 3 against system noise
+        out = subprocess.check_output([sys.executable, "-c", _IMPORT_BENCH],
+                                      universal_newlines=True).split()
+        timings.append(float(out[0]))
+        assert out[1] == "False", "matplotlib imported by aurem"
+        assert out[2] == "False", "C extension loaded at import time"
+    assert min(timings) < IMPORT_TIME_BUDGET, (
+        "aurem import took %.3f s (budget %.3f s)" %
+        (min(timings), IMPORT_TIME_BUDGET))
+
+
+def test_aurem_metrics(tmp_path):
+    """ Test the Prometheus metrics of the pickers aganist obspy.read()
+    """
+    from urllib.request import urlopen
+    from aurem import metrics
+    #
+    st = read()
+    st.filter('highpass', freq=2, corners=4)
+    st.trim(st[0].stats.starttime + 1, UTCDateTime("2009-08-24T00:20:11"))
+
+    metrics.REGISTRY.reset()
+    metrics.enable()
+    try:
+        for _ in range(3):
+            aicobj = AIC(st, channel="*Z")
+            aicobj.work()
+        recobj = REC(st, channel="*Z")
+        recobj.work()
+    finally:
+        metrics.disable()
+
+    # --- Exposition
+    labels = 'method="AIC",engine="dense",length_le="1000"'
+    text = metrics.render()
+    assert "aurem_traces_total{%s} 3" % labels in text
+    assert "aurem_pick_duration_seconds_count{%s} 3" % labels in text
+    assert 'aurem_traces_total{method="REC"' in text
+    assert "aurem_nopicks_total{" not in text
+
+    # --- File dump
+    metrics.dump(tmp_path / "aurem.prom")
+    assert (tmp_path / "aurem.prom").read_text() == text
+
+    # --- HTTP endpoint
+    server = metrics.start_http_server(port=0)
+    try:
+        body = urlopen("http://127.0.0.1:%d/metrics" %
+                       server.server_address[1]).read().decode("utf-8")
+    finally:
+        server.shutdown()
+    assert body == text
+    metrics.REGISTRY.reset()
+
+
+def test_aurem_metrics_cli_workers(tmp_path):
+    """ Test the aurem-pick metrics file, collected by pool workers
+    """
+    import os
+    import stat
+    from aurem.cli import main
+    from aurem import metrics
+    #
+    for _ii in range(3):
+        read().write(str(tmp_path / ("example%d.mseed" % _ii)),
+                     format="MSEED")
+    metricsfile = tmp_path / "aurem.prom"
+    metrics.REGISTRY.reset()
+    try:
+        ret = main([str(tmp_path / "*.mseed"), "--workers", "2",
+                    "--output", str(tmp_path / "picks.csv"),
+                    "--metrics-file", str(metricsfile), "--quiet"])
+    finally:
+        metrics.disable()
+        metrics.REGISTRY.reset()
+
+    # --- 3 files x 3 channels, merged from the workers
+    assert ret == 0
+    text = metricsfile.read_text()
+    total = sum(int(_ll.split()[-1]) for _ll in text.splitlines()
+                if _ll.startswith("aurem_traces_total{"))
+    assert total == 9
+    # readable by other users (e.g. node_exporter)
+    assert stat.S_IMODE(os.stat(str(metricsfile)).st_mode) == 0o644